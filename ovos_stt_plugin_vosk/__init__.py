@@ -1,23 +1,64 @@
+import errno
+import gc
+import hashlib
+import io
 import json
 import os
+import re
 import shutil
 import tarfile
 import zipfile
+import zlib
+from collections import OrderedDict, deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from os import makedirs
-from os.path import join, isdir, exists
-from queue import Queue
+from os.path import dirname, join, exists
+from queue import Queue, SimpleQueue
+from threading import Event, Lock, RLock, Semaphore, Thread, local
 from tempfile import mkstemp
-from time import sleep
+from time import sleep, time
+from types import MappingProxyType
 
-import requests
 from ovos_plugin_manager.templates.stt import STT, StreamThread, StreamingSTT
 from ovos_utils.log import LOG
 from ovos_utils.network_utils import is_connected
 from ovos_utils.xdg_utils import xdg_data_home
-from speech_recognition import AudioData
-from vosk import Model as KaldiModel, KaldiRecognizer
 
-_lang2url = {
+# vosk loads a big native library, only import it once a model is needed
+# so enumerating plugins does not pay for it
+KaldiModel = KaldiRecognizer = None
+
+
+def _import_vosk():
+    global KaldiModel, KaldiRecognizer
+    if KaldiRecognizer is None:
+        from vosk import Model as KaldiModel, KaldiRecognizer
+
+
+try:
+    # optional, considerably faster to parse the recognizer results
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+try:
+    # optional, ISA-L gzip decompresses tar.gz models several times faster
+    from isal import igzip as _igzip
+except ImportError:
+    _igzip = None
+
+# vosk results have a fixed layout, eg. '{\n  "partial" : "hello world"\n}'
+# values containing escape sequences do not match and are json parsed instead
+_PARTIAL_RE = re.compile(r'"partial"\s*:\s*"([^"\\]*)"')
+_TEXT_RE = re.compile(r'"text"\s*:\s*"([^"\\]*)"')
+
+# 100ms of 16kHz 16bit silence
+_WARMUP_AUDIO = bytes(3200)
+# 1s of 16kHz 16bit pcm, long audio is fed to the recognizer in blocks of this
+_PCM_BLOCK_SIZE = 32000
+
+_lang2url = MappingProxyType({
     "en": "http://alphacephei.com/vosk/models/vosk-model-small-en-us-0.15.zip",
     "en-in": "http://alphacephei.com/vosk/models/vosk-model-small-en-in-0.4.zip",
     "cn": "https://alphacephei.com/vosk/models/vosk-model-small-cn-0.3.zip",
@@ -35,8 +76,8 @@ _lang2url = {
     "ar": "https://alphacephei.com/vosk/models/vosk-model-ar-mgb2-0.4.zip",
     "fa": "https://alphacephei.com/vosk/models/vosk-model-small-fa-0.5.zip",
     "tl": "https://alphacephei.com/vosk/models/vosk-model-tl-ph-generic-0.6.zip"
-}
-_biglang2url = {
+})
+_biglang2url = MappingProxyType({
     "en": "https://alphacephei.com/vosk/models/vosk-model-en-us-aspire-0.2.zip",
     "en-in": "http://alphacephei.com/vosk/models/vosk-model-en-in-0.4.zip",
     "cn": "https://alphacephei.com/vosk/models/vosk-model-cn-0.1.zip",
@@ -46,189 +87,730 @@ _biglang2url = {
     "nl": "https://alphacephei.com/vosk/models/vosk-model-nl-spraakherkenning-0.6.zip",
     "fa": "https://alphacephei.com/vosk/models/vosk-model-fa-0.5.zip",
     "it": "https://alphacephei.com/vosk/models/vosk-model-it-0.22.zip"
+})
+# big models where available, small otherwise
+_alllang2url = MappingProxyType({**_lang2url, **_biglang2url})
 
-}
 
-VoskSTTConfig = {
-    lang: [{"model": url,
+def _model_config(lang, url, priority, size):
+    return {"model": url,
             "lang": lang,
             "meta": {
-                "priority": 40,
-                "display_name": url.split("/")[-1].replace(".zip", "") + " (Small)",
+                "priority": priority,
+                "display_name": url.rsplit("/", 1)[-1].replace(".zip", "") + f" ({size})",
                 "offline": True}
-            }]
-    for lang, url in _lang2url.items()
-}
-for lang, url in _biglang2url.items():
-    VoskSTTConfig[lang].append({"model": url,
-                                "lang": lang,
-                                "meta": {
-                                    "priority": 70,
-                                    "display_name": url.split("/")[-1].replace(".zip", "") + " (Large)",
-                                    "offline": True}
-                                })
+            }
+
+
+@lru_cache()
+def _build_config():
+    """ VoskSTTConfig is only built if something asks for it """
+    config = {lang: [_model_config(lang, url, 40, "Small")]
+              for lang, url in _lang2url.items()}
+    for lang, url in _biglang2url.items():
+        config[lang].append(_model_config(lang, url, 70, "Large"))
+    return config
+
+
+def __getattr__(name):
+    if name == "VoskSTTConfig":
+        return _build_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _extract_result(res, regex, key):
+    """ read a string field from a vosk result without a full json parse """
+    match = regex.search(res)
+    if match:
+        return match.group(1)
+    return _json_loads(res)[key]
+
+
+def _partial_affixes(empty_result):
+    """ split an empty partial result into what surrounds the text
+
+    eg. '{\n  "partial" : ""\n}' -> ('{\n  "partial" : "', '"\n}')
+    """
+    if '""' not in empty_result:
+        return None
+    prefix, _, suffix = empty_result.partition('""')
+    return prefix + '"', '"' + suffix
+
+
+def _readahead(path, min_size=1024 * 1024):
+    """ ask the kernel to start reading the big model files into the page cache
+
+    the reads happen in the background, overlapping with the model loading
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                _readahead(entry.path, min_size)
+            elif entry.is_file() and entry.stat().st_size >= min_size:
+                fd = os.open(entry.path, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+        except OSError:
+            continue
 
 
 class ModelContainer:
-    def __init__(self):
-        self.engines = {}
+    # model_path -> KaldiModel, shared by every recognizer in the process
+    _MODEL_REGISTRY = {}
+    # model_path -> number of containers with a language loaded from it
+    _MODEL_USERS = {}
+    _REGISTRY_LOCK = Lock()
+    # loaded from disk on first use, see load_manifest
+    _manifest = None
+
+    def __init__(self, max_languages=2, parallel_download=True):
+        # lang -> active KaldiRecognizer, least recently used first
+        self.engines = OrderedDict()
+        # languages kept loaded at once, None for no limit
+        self.max_languages = max_languages
+        # download models with concurrent range requests
+        self.parallel_download = parallel_download
         self.models = {}
+        # lang -> {grammar: KaldiRecognizer}, reused when switching vocabulary
+        self.recognizers = {}
+        # layout of partial results, probed from the first recognizer
+        self._partial_affixes = None
+        # lang or checked out recognizer -> (last raw partial result, text)
+        self.partials = {}
+        # lang -> grammar of the active recognizer, None for full vocabulary
+        self.grammars = {}
+        # (lang, grammar) -> idle extra recognizers for concurrent streams,
+        # the cached recognizer in self.recognizers is always handed out first
+        self.pools = {}
+        self.pool_size = os.cpu_count() or 1
+        # checked out recognizer -> (lang, grammar) it was created for
+        self.checked_out = {}
+        # guards checked_out and pools, vosk releases the GIL in Reset
+        self._pool_lock = RLock()
+        # model paths counted in _MODEL_USERS for this container
+        self._held_models = set()
+
+    @staticmethod
+    def normalize_lang(lang):
+        """ models are stored by the short lang code, 'en-US' -> 'en' """
+        return lang.partition("-")[0].lower()
 
     def get_engine(self, lang):
-        lang = lang.split("-")[0].lower()
-        self.load_language(lang)
-        return self.engines[lang]
+        return self._get_engine(self.normalize_lang(lang))
+
+    def _get_engine(self, lang):
+        """ get_engine for an already normalized lang """
+        engine = self.engines.get(lang)
+        if engine is None:
+            self.load_language(lang)
+            engine = self.engines[lang]
+        self.engines.move_to_end(lang)
+        return engine
+
+    def _set_engine(self, lang, engine):
+        self.engines[lang] = engine
+        self.engines.move_to_end(lang)
+        # free the least recently used languages
+        while self.max_languages and len(self.engines) > self.max_languages:
+            self.unload_language(next(iter(self.engines)))
+
+    def checkout_engine(self, lang):
+        """ get a recognizer for the exclusive use of one stream
+
+        recognizers share the loaded model and decode in parallel, return
+        it with checkin_engine once done
+        """
+        lang = self.normalize_lang(lang)
+        with self._pool_lock:
+            # concurrent first calls load the language only once
+            engine = self._get_engine(lang)
+            grammar = self.grammars.get(lang)
+            if engine in self.checked_out:
+                try:
+                    engine = self.pools.get((lang, grammar), []).pop()
+                except IndexError:
+                    engine = self._create_recognizer(lang, grammar)
+            self.checked_out[engine] = (lang, grammar)
+        engine.Reset()
+        return engine
 
-    def get_partial_transcription(self, lang):
-        engine = self.get_engine(lang)
+    def checkin_engine(self, engine):
+        """ return a recognizer taken with checkout_engine """
+        with self._pool_lock:
+            self.partials.pop(engine, None)
+            key = self.checked_out.pop(engine, None)
+            if key is None:
+                # its language was unloaded or reloaded meanwhile
+                return
+            lang, grammar = key
+            if engine is self.recognizers.get(lang, {}).get(grammar):
+                # the cached recognizer, available again to the next checkout
+                return
+            pool = self.pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(engine)
+
+    def get_partial_transcription(self, lang, engine=None):
+        lang = self.normalize_lang(lang)
+        key = engine or lang
+        engine = engine or self._get_engine(lang)
         res = engine.PartialResult()
-        return json.loads(res)["partial"]
+        # the partial is usually unchanged between consecutive chunks
+        last_res, text = self.partials.get(key, (None, ""))
+        if res != last_res:
+            text = self._parse_partial(res)
+            self.partials[key] = (res, text)
+        return text
+
+    def _parse_partial(self, res):
+        if self._partial_affixes:
+            # fast path, slice the text out of the known layout
+            prefix, suffix = self._partial_affixes
+            if res.startswith(prefix) and res.endswith(suffix):
+                text = res[len(prefix):len(res) - len(suffix)]
+                if '"' not in text and "\\" not in text:
+                    return text
+        return _extract_result(res, _PARTIAL_RE, "partial")
 
-    def get_final_transcription(self, lang):
-        engine = self.get_engine(lang)
+    def get_final_transcription(self, lang, engine=None):
+        engine = engine or self.get_engine(lang)
         res = engine.FinalResult()
-        return json.loads(res)["text"]
+        return _extract_result(res, _TEXT_RE, "text")
 
-    def process_audio(self, audio, lang):
-        engine = self.get_engine(lang)
-        if isinstance(audio, AudioData):
-            audio = audio.get_wav_data()
-        return engine.AcceptWaveform(audio)
+    def process_audio(self, audio, lang, engine=None):
+        engine = engine or self.get_engine(lang)
+        # duck typed speech_recognition.AudioData, not imported just for
+        # an isinstance check
+        get_raw_data = getattr(audio, "get_raw_data", None)
+        if get_raw_data is not None:
+            # the recognizer expects bare 16kHz 16bit pcm, no wav header
+            audio = get_raw_data(convert_rate=16000, convert_width=2)
+        if len(audio) <= 2 * _PCM_BLOCK_SIZE:
+            return engine.AcceptWaveform(audio)
+        # long recordings are decoded in 1s blocks, keeping the decoder
+        # buffers small instead of scoring minutes of audio at once
+        view = memoryview(audio)
+        for offset in range(0, len(view), _PCM_BLOCK_SIZE):
+            # vosk only accepts bytes objects
+            endpoint = engine.AcceptWaveform(
+                bytes(view[offset:offset + _PCM_BLOCK_SIZE]))
+        return endpoint
+
+    @classmethod
+    def get_kaldi_model(cls, model_path):
+        """ load a kaldi model once, further calls with the same path reuse it """
+        if model_path not in cls._MODEL_REGISTRY:
+            _import_vosk()
+            _readahead(model_path)
+            cls._MODEL_REGISTRY[model_path] = KaldiModel(model_path)
+        return cls._MODEL_REGISTRY[model_path]
 
     def enable_limited_vocabulary(self, words, lang):
         """
         enable limited vocabulary mode
         will only consider pre defined .voc files
         """
-        model_path = self.models[lang]
-        self.engines[lang] = KaldiRecognizer(
-            KaldiModel(model_path), 16000, json.dumps(words))
+        lang = self.normalize_lang(lang)
+        # reload evicted languages, holding their model
+        self.load_language(lang)
+        grammar = json.dumps(words)
+        self._set_engine(lang, self.get_recognizer(lang, grammar))
+        self.grammars[lang] = grammar
 
-    def enable_full_vocabulary(self, lang=None):
+    def enable_full_vocabulary(self, lang):
         """ enable default transcription mode """
-        model_path = self.models[lang]
-        self.engines[lang] = KaldiRecognizer(
-            KaldiModel(model_path), 16000)
+        lang = self.normalize_lang(lang)
+        self.load_language(lang)
+        self._set_engine(lang, self.get_recognizer(lang))
+        self.grammars[lang] = None
+
+    def get_recognizer(self, lang, grammar=None):
+        """ return a clean recognizer for lang, created once per grammar """
+        cache = self.recognizers.setdefault(lang, {})
+        engine = cache.get(grammar)
+        if engine is None:
+            engine = cache[grammar] = self._create_recognizer(lang, grammar)
+        elif engine not in self.checked_out:
+            # a stream using it resets it itself
+            engine.Reset()
+        return engine
+
+    def _create_recognizer(self, lang, grammar=None):
+        model = self.get_kaldi_model(self.models[lang])
+        if grammar:
+            engine = KaldiRecognizer(model, 16000, grammar)
+        else:
+            engine = KaldiRecognizer(model, 16000)
+        # decode 100ms of silence so the first utterance does not pay
+        # for the lazy decoder allocations
+        engine.AcceptWaveform(_WARMUP_AUDIO)
+        engine.FinalResult()
+        engine.Reset()
+        if self._partial_affixes is None:
+            self._partial_affixes = _partial_affixes(engine.PartialResult())
+        return engine
 
     def load_model(self, model_path, lang):
-        lang = lang.split("-")[0].lower()
+        lang = self.normalize_lang(lang)
+        previous = self.models.get(lang) if lang in self.engines else None
         self.models[lang] = model_path
         if model_path:
-            self.engines[lang] = KaldiRecognizer(KaldiModel(model_path), 16000)
+            self._hold_model(model_path)
+            self.recognizers.pop(lang, None)
+            self._drop_pools(lang)
+            self._set_engine(lang, self.get_recognizer(lang))
+            self.grammars[lang] = None
+            if previous and previous != model_path:
+                self._release_model(previous)
         else:
             raise FileNotFoundError
 
+    def _hold_model(self, model_path):
+        with self._REGISTRY_LOCK:
+            if model_path not in self._held_models:
+                self._held_models.add(model_path)
+                self._MODEL_USERS[model_path] = \
+                    self._MODEL_USERS.get(model_path, 0) + 1
+
+    def _release_model(self, model_path):
+        """ drop the shared model once no loaded language of any container uses it """
+        if any(self.models.get(lang) == model_path for lang in self.engines):
+            return
+        with self._REGISTRY_LOCK:
+            if model_path not in self._held_models:
+                return
+            self._held_models.discard(model_path)
+            users = self._MODEL_USERS.pop(model_path, 1) - 1
+            if users > 0:
+                self._MODEL_USERS[model_path] = users
+            else:
+                # recognizers elsewhere keep the native model alive, vosk
+                # refcounts it, this only drops our reference
+                self._MODEL_REGISTRY.pop(model_path, None)
+
     def load_language(self, lang):
-        lang = lang.split("-")[0].lower()
+        lang = self.normalize_lang(lang)
         if lang in self.engines:
             return
-        model_path = self.download_language(lang)
+        # reload unloaded languages from the model they were using
+        model_path = self.models.get(lang) or \
+            self.download_language(lang, self.parallel_download)
         self.load_model(model_path, lang)
 
+    def load_languages(self, langs):
+        """ load several languages, reading their models in parallel
+
+        vosk releases the GIL while a model loads, the recognizers are then
+        created one by one from the already loaded models
+
+        at most max_languages are kept, the first ones given take priority
+        """
+        langs = list(dict.fromkeys(map(self.normalize_lang, langs)))
+        if self.max_languages and len(langs) > self.max_languages:
+            LOG.warning(f"max_languages is {self.max_languages}, "
+                        f"not loading {langs[self.max_languages:]}")
+            langs = langs[:self.max_languages]
+        # keep the requested languages that are loaded already from being
+        # evicted by the new ones
+        for lang in langs:
+            if lang in self.engines:
+                self.engines.move_to_end(lang)
+        langs = [lang for lang in langs if lang not in self.engines]
+        # downloads update the shared manifest, do them one at a time
+        paths = {lang: self.models.get(lang) or
+                 self.download_language(lang, self.parallel_download)
+                 for lang in langs}
+        unique = [path for path in dict.fromkeys(paths.values())
+                  if path and path not in self._MODEL_REGISTRY]
+        if len(unique) > 1:
+            with ThreadPoolExecutor(max_workers=len(unique)) as pool:
+                for _ in pool.map(self.get_kaldi_model, unique):
+                    pass
+        for lang, path in paths.items():
+            self.load_model(path, lang)
+
+    def _drop_pools(self, lang):
+        with self._pool_lock:
+            for key in [key for key in self.pools if key[0] == lang]:
+                del self.pools[key]
+            # recognizers still in use are discarded when checked in
+            for engine in [engine for engine, key in self.checked_out.items()
+                           if key[0] == lang]:
+                del self.checked_out[engine]
+
     def unload_language(self, lang):
-        if lang in self.engines:
-            del self.engines[lang]
-            self.engines.pop(lang)
+        lang = self.normalize_lang(lang)
+        engine = self.engines.pop(lang, None)
+        self.recognizers.pop(lang, None)
+        self.partials.pop(lang, None)
+        self.grammars.pop(lang, None)
+        self._drop_pools(lang)
+        if engine is None:
+            return
+        # the model path is kept so the language can be reloaded later
+        self._release_model(self.models.get(lang))
+        del engine
+        # free the native memory now rather than on the next gc cycle
+        gc.collect()
 
     @staticmethod
-    def download_language(lang):
-        lang = lang.split("-")[0].lower()
+    def download_language(lang, parallel=True):
+        lang = ModelContainer.normalize_lang(lang)
         model_path = ModelContainer.lang2modelurl(lang)
         if model_path and model_path.startswith("http"):
-            model_path = ModelContainer.download_model(model_path)
+            model_path = ModelContainer.download_model(model_path, parallel)
         return model_path
 
+    @classmethod
+    def load_manifest(cls):
+        """ url -> model info of every model downloaded by this plugin """
+        if cls._manifest is None:
+            try:
+                with open(join(xdg_data_home(), 'vosk', 'manifest.json')) as f:
+                    cls._manifest = json.load(f)
+            except (OSError, ValueError):
+                cls._manifest = {}
+        return cls._manifest
+
+    @classmethod
+    def save_manifest(cls):
+        path = join(xdg_data_home(), 'vosk', 'manifest.json')
+        # write a temp file and replace, the manifest is never left half written
+        with open(path + ".tmp", "w") as f:
+            json.dump(cls.load_manifest(), f, indent=2)
+        os.replace(path + ".tmp", path)
+
     @staticmethod
-    def download_model(url):
+    def download_model(url, parallel=True):
+        manifest = ModelContainer.load_manifest()
+        if url in manifest and manifest[url].get("complete", True) and \
+                exists(manifest[url]["path"]):
+            return manifest[url]["path"]
+
         folder = join(xdg_data_home(), 'vosk')
         name = url.split("/")[-1].rsplit(".", 1)[0]
         model_path = join(folder, name)
+        sha256 = None
         if not exists(model_path):
+            delay = 0.5
             while not is_connected():
                 LOG.info("Waiting for internet in order to download vosk language model")
-                # waiting for wifi setup most likely
-                sleep(10)
+                # waiting for wifi setup most likely, check often at first
+                sleep(delay)
+                delay = min(delay * 2, 10)
             LOG.info(f"Downloading model for vosk {url}")
             LOG.info("this might take a while")
-            if url.endswith(".zip"):
-                download_extract_zip(url, folder=folder, skill_folder_name=name)
-            else:
-                download_extract_tar(url, folder=folder, skill_folder_name=name)
+            # extract next to the final path and rename it only once complete,
+            # an interrupted download never leaves a partial model behind
+            tmp_folder = model_path + ".part"
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            try:
+                parts = _DOWNLOAD_PARTS if parallel else 1
+                if url.endswith(".zip"):
+                    sha256 = download_extract_zip(url, folder=tmp_folder,
+                                                  skill_folder_name=name,
+                                                  parts=parts,
+                                                  cache_folder=folder)
+                else:
+                    sha256 = download_extract_tar(url, folder=tmp_folder,
+                                                  skill_folder_name=name,
+                                                  parts=parts)
+                os.rename(join(tmp_folder, name), model_path)
+            finally:
+                shutil.rmtree(tmp_folder, ignore_errors=True)
             LOG.info(f"Model downloaded to {model_path}")
 
+        manifest[url] = {"path": model_path, "downloaded": time(),
+                         "sha256": sha256 or manifest.get(url, {}).get("sha256"),
+                         "complete": True}
+        ModelContainer.save_manifest()
         return model_path
 
     @staticmethod
     def lang2modelurl(lang, small=True):
-        if not small:
-            _lang2url.update(_biglang2url)
+        urls = _lang2url if small else _alllang2url
         lang = lang.lower()
-        if lang in _lang2url:
-            return _lang2url[lang]
-        lang = lang.split("-")[0]
-        return _lang2url.get(lang)
+        return urls.get(lang) or urls.get(lang.partition("-")[0])
 
 
 class VoskKaldiSTT(STT):
+    # shared by all instances for background model downloads and loading
+    _executor = ThreadPoolExecutor(max_workers=1)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # model_folder for backwards compat
         model_path = self.config.get("model_folder") or self.config.get("model")
 
-        self.model = ModelContainer()
+        self.model = ModelContainer(self.config.get("max_languages", 2),
+                                    self.config.get("parallel_download", True))
+        self._ready = None
+        if self.config.get("background_load", False):
+            # return right away, the model is awaited on first use
+            self._ready = self._executor.submit(self._load_model, model_path)
+        else:
+            self._load_model(model_path)
+        self.verbose = True
+
+    def _load_model(self, model_path):
         if model_path:
             if model_path.startswith("http"):
-                model_path = ModelContainer.download_model(model_path)
+                model_path = ModelContainer.download_model(
+                    model_path, self.model.parallel_download)
             self.model.load_model(model_path, self.lang)
         else:
             self.model.load_language(self.lang)
-        self.verbose = True
+
+    def wait_until_ready(self):
+        """ block until the model is loaded, raises if loading failed """
+        if self._ready is not None:
+            self._ready.result()
 
     def load_language(self, lang):
+        self.wait_until_ready()
         self.model.load_language(lang)
 
-    def unload_language(self, lang):
-        self.model.unload_language(lang)
+    def load_languages(self, langs):
+        self.wait_until_ready()
+        # the plugin language is never evicted in favour of these
+        self.model.load_languages([self.lang] + list(langs))
+
+    def _settle_loading(self, cancel=False):
+        """ cancel a pending background load or wait for a running one
+
+        otherwise the model would be loaded after it was unloaded
+        """
+        if self._ready is None or (cancel and self._ready.cancel()):
+            return
+        try:
+            self._ready.result()
+        except Exception as e:
+            LOG.error(f"vosk model failed to load: {e}")
+
+    def unload_language(self, lang=None):
+        self._settle_loading()
+        self.model.unload_language(lang or self.lang)
+
+    def shutdown(self):
+        self._settle_loading(cancel=True)
+        for lang in tuple(self.model.engines):
+            self.unload_language(lang)
 
     def enable_limited_vocabulary(self, words, lang):
+        self.wait_until_ready()
         self.model.enable_limited_vocabulary(words, lang or self.lang)
 
     def enable_full_vocabulary(self, lang=None):
+        self.wait_until_ready()
         self.model.enable_full_vocabulary(lang or self.lang)
 
     def execute(self, audio, language=None):
+        self.wait_until_ready()
         lang = language or self.lang
-        self.model.process_audio(audio, lang)
-        return self.model.get_final_transcription(lang)
+        # a recognizer of its own, concurrent calls decode in parallel
+        engine = self.model.checkout_engine(lang)
+        try:
+            self.model.process_audio(audio, lang, engine)
+            return self.model.get_final_transcription(lang, engine)
+        finally:
+            self.model.checkin_engine(engine)
+
+
+class _AudioQueue(Queue):
+    """ bounded audio queue that never blocks the producer
+
+    when the recognizer falls behind the oldest chunks are dropped, keeping
+    the most recent audio and bounding memory usage
+    """
+
+    # seconds between warnings about dropped audio
+    warning_interval = 5
+
+    def __init__(self, maxlen=None):
+        self.maxlen = maxlen or None
+        self.dropped = 0
+        self._last_warning = 0
+        super().__init__()
+
+    def _init(self, maxsize):
+        self.queue = deque(maxlen=self.maxlen)
+
+    def _put(self, item):
+        if self.maxlen and len(self.queue) == self.maxlen:
+            # the oldest chunk is evicted and will never be marked done
+            self.unfinished_tasks -= 1
+            self.dropped += 1
+            now = time()
+            if now - self._last_warning >= self.warning_interval:
+                LOG.warning(f"vosk is falling behind, dropped {self.dropped} "
+                            f"audio chunks")
+                self._last_warning = now
+                self.dropped = 0
+        self.queue.append(item)
+
+
+class _PartialLogger:
+    """ logs partial transcriptions from a daemon thread, off the audio thread """
+    _queue = SimpleQueue()
+    _thread = None
+    _lock = Lock()
+
+    @classmethod
+    def _run(cls):
+        while True:
+            LOG.info("Partial Transcription: " + cls._queue.get())
+
+    @classmethod
+    def log(cls, text):
+        if cls._thread is None:
+            with cls._lock:
+                if cls._thread is None:
+                    cls._thread = Thread(target=cls._run, daemon=True)
+                    cls._thread.start()
+        cls._queue.put_nowait(text)
 
 
 class VoskKaldiStreamThread(StreamThread):
-    def __init__(self, queue, lang, model, verbose=True):
+    def __init__(self, queue, lang, model, verbose=True, batch_ms=100,
+                 partial_interval=2):
         super().__init__(queue, lang)
         self.model = model
+        # every stream decodes with its own recognizer, checked out once
+        # the stream language is known
+        self.engine = None
         self.verbose = verbose
+        self.text = ""
         self.previous_partial = ""
-        self.running = True
+        self.running = Event()
+        self.running.set()
+        # audio is 16kHz 16bit mono, 32 bytes per millisecond
+        self.batch_size = int(batch_ms * 32)
+        # read the partial transcription every N batches
+        self.partial_interval = max(1, partial_interval)
+        self._buffer = bytearray()
+        # finalize is called from another thread, the recognizer is not thread safe
+        self._lock = Lock()
+
+    def _get_data(self):
+        """ yield everything queued since the last read as a single chunk
+
+        the queue is drained with one lock acquire instead of a get and
+        task_done pair per audio frame
+        """
+        q = self.queue
+        while True:
+            chunks = [q.get()]
+            with q.mutex:
+                chunks.extend(q.queue)
+                q.queue.clear()
+                q.unfinished_tasks -= len(chunks)
+                if not q.unfinished_tasks:
+                    q.all_tasks_done.notify_all()
+                q.not_full.notify_all()
+            # None marks the end of the stream
+            end = None in chunks
+            if end:
+                chunks = chunks[:chunks.index(None)]
+            if chunks:
+                yield b"".join(chunks)
+            if end:
+                break
+
+    def _checkout_engine(self, lang):
+        """ the recognizer of this stream, call with self._lock held """
+        if self.engine is None:
+            self.engine = self.model.checkout_engine(lang)
+        return self.engine
+
+    def _process_buffer(self, lang):
+        endpoint = self.model.process_audio(bytes(self._buffer), lang,
+                                            self.engine)
+        self._buffer.clear()
+        return endpoint
 
     def handle_audio_stream(self, audio, language):
         lang = language or self.language
-        if self.running:
-            for a in audio:
-                self.model.process_audio(a, lang)
-                self.text = self.model.get_partial_transcription(lang)
-                if self.verbose:
-                    if self.previous_partial != self.text:
-                        LOG.info("Partial Transcription: " + self.text)
-                self.previous_partial = self.text
+        # bind the per chunk lookups once, this loop runs for every chunk
+        lock, buffer, batch_size = self._lock, self._buffer, self.batch_size
+        process_buffer = self._process_buffer
+        get_partial = self.model.get_partial_transcription
+        running = self.running.is_set
+        interval, batches = self.partial_interval, 0
+        with lock:
+            if not running():
+                return self.text
+            engine = self._checkout_engine(lang)
+        for a in audio:
+            with lock:
+                # stop decoding as soon as the stream is finalized
+                if not running():
+                    break
+                buffer += a
+                if len(buffer) < batch_size:
+                    continue
+                endpoint = process_buffer(lang)
+                batches += 1
+                if not endpoint and batches % interval:
+                    continue
+                text = get_partial(lang, engine)
+                if text == self.previous_partial:
+                    continue
+                self.text = self.previous_partial = text
+            if self.verbose:
+                _PartialLogger.log(text)
+        return self.text
+
+    def handle_bulk_audio(self, pcm, language=None):
+        """ decode a single large pcm buffer
+
+        the buffer is sliced into batch sized frames through a memoryview,
+        no intermediate copies of the whole audio are made
+        """
+        lang = language or self.language
+        frame = self.batch_size or len(_WARMUP_AUDIO)
+        view = memoryview(pcm)
+        with self._lock:
+            if not self.running.is_set():
+                return self.text
+            self._checkout_engine(lang)
+            if self._buffer:
+                # audio queued before this buffer is decoded first
+                self._process_buffer(lang)
+            for offset in range(0, len(view), frame):
+                # vosk only accepts bytes objects
+                self.model.process_audio(bytes(view[offset:offset + frame]),
+                                         lang, self.engine)
+            text = self.model.get_partial_transcription(lang, self.engine)
+            changed = text != self.previous_partial
+            if changed:
+                self.text = self.previous_partial = text
+        if changed and self.verbose:
+            _PartialLogger.log(text)
         return self.text
 
     def finalize(self):
-        self.running = False
-        if self.previous_partial:
-            if self.verbose:
-                LOG.info("Finalizing stream")
-            self.text = self.model.get_final_transcription(self.language)
-            self.previous_partial = ""
+        self.running.clear()
+        with self._lock:
+            pending = bool(self._buffer)
+            if pending:
+                self._process_buffer(self.language)
+            if self.previous_partial or pending:
+                if self.verbose:
+                    LOG.info("Finalizing stream")
+                self.text = self.model.get_final_transcription(self.language,
+                                                               self.engine)
+                self.previous_partial = ""
+            if self.engine is not None:
+                self.model.checkin_engine(self.engine)
+                self.engine = None
         text = str(self.text)
         self.text = ""
         return text
@@ -239,13 +821,65 @@ class VoskKaldiStreamingSTT(StreamingSTT, VoskKaldiSTT):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.verbose = self.config.get("verbose", False)
+        self.batch_ms = self.config.get("stream_batch_ms", 100)
+        self.queue_size = self.config.get("stream_queue_size", 100)
+        self.partial_interval = self.config.get("stream_partial_interval", 2)
 
     def create_streaming_thread(self):
-        self.queue = Queue()
+        self.wait_until_ready()
+        self.queue = _AudioQueue(self.queue_size)
         return VoskKaldiStreamThread(
-            self.queue, self.lang, self.model, self.verbose
+            self.queue, self.lang, self.model, self.verbose, self.batch_ms,
+            self.partial_interval
         )
-def download(url, file=None, session=None):
+
+
+_CHUNK_SIZE = 1024 * 1024
+# model archives are dominated by a few big files, the stdlib copies them
+# in 16KiB (tar) / 64KiB (zip) blocks
+_COPY_BUFSIZE = 2 * 1024 * 1024
+
+
+# concurrent range requests used to download a model
+_DOWNLOAD_PARTS = 4
+# zip archives smaller than this are extracted from memory
+_IN_MEMORY_ZIP_SIZE = 128 * 1024 * 1024
+# tar members up to this size are written to disk by a pool of threads
+_TAR_WORKER_MAX_SIZE = 1024 * 1024
+_TAR_WORKERS = 4
+_SESSION = None
+
+
+def _get_session():
+    """ shared http session, connections are kept alive and reused """
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        _SESSION = requests.Session()
+        # transient network and server errors are retried with a backoff
+        # instead of failing a whole model download
+        retry = Retry(total=3, backoff_factor=0.5,
+                      status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=_DOWNLOAD_PARTS,
+                              pool_maxsize=_DOWNLOAD_PARTS,
+                              max_retries=retry)
+        _SESSION.mount("http://", adapter)
+        _SESSION.mount("https://", adapter)
+    return _SESSION
+
+
+def _request(url, session=None, headers=None):
+    """ start a streaming GET request, raising on http errors """
+    session = session or _get_session()
+    r = session.get(url, headers=headers, stream=True)
+    r.raise_for_status()
+    return r
+
+
+def download(url, file=None, session=None, hasher=None):
     """
     Pass file as a filename, open file object, or None to return the request bytes
 
@@ -255,6 +889,7 @@ def download(url, file=None, session=None):
              - Filename of output file
              - File opened in binary write mode
              - None: Return raw bytes instead
+        hasher: optional hashlib object updated with the downloaded bytes
 
     Returns:
         Union[bytes, None]: Bytes of file if file is None
@@ -263,85 +898,490 @@ def download(url, file=None, session=None):
     if isinstance(file, str):
         file = open(file, 'wb')
     try:
-        if session:
-            content = session.get(url).content
-        else:
-            content = requests.get(url).content
-        if file:
-            file.write(content)
-        else:
-            return content
+        with _request(url, session) as r:
+            if not file:
+                if hasher:
+                    hasher.update(r.content)
+                return r.content
+            # write while downloading instead of buffering the whole archive
+            for chunk in r.iter_content(chunk_size=_CHUNK_SIZE):
+                if hasher:
+                    hasher.update(chunk)
+                file.write(chunk)
     finally:
         if file:
             file.close()
 
 
+def _download_range(url, fd, start, end, session=None, progress=None):
+    """ download bytes start-end (inclusive) of url into the same offsets of fd
+
+    progress is called with the offset written so far after every chunk
+    """
+    offset = start
+    with _request(url, session, {"Range": f"bytes={start}-{end}"}) as r:
+        if r.status_code != 206:
+            raise IOError(f"range request not supported: {url}")
+        for chunk in r.iter_content(chunk_size=_CHUNK_SIZE):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            if progress is not None:
+                progress(offset)
+    if offset != end + 1:
+        raise IOError(f"incomplete download: {url}")
+
+
+def _content_length(url, session=None):
+    """ size of the file at url, None if the server does not report it """
+    session = session or _get_session()
+    size = session.head(url, allow_redirects=True).headers.get("Content-Length")
+    return int(size) if size else None
+
+
+def _progress_file(filename):
+    """ sidecar recording which byte ranges of a resumable download are done """
+    return filename + ".progress"
+
+
+def _load_progress(filename, size, validator):
+    """ ranges left to download from the sidecar, None if it is missing or stale """
+    if not exists(filename):
+        return None
+    try:
+        with open(_progress_file(filename)) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("size") != size or state.get("validator") != validator:
+        # the remote file changed since
+        return None
+    return [list(r) for r in state["ranges"]]
+
+
+def _save_progress(filename, size, validator, ranges):
+    path = _progress_file(filename)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"size": size, "validator": validator, "ranges": ranges}, f)
+    os.replace(path + ".tmp", path)
+
+
+def _remove_partial(filename):
+    """ delete a resumable download and its progress sidecar """
+    for path in (filename, _progress_file(filename)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def parallel_download(url, filename, session=None, parts=_DOWNLOAD_PARTS,
+                      resume=False):
+    """
+    Download url to filename splitting it into concurrent range requests
+
+    A single connection is often limited well below the available bandwidth,
+    falls back to a regular download if the server does not support ranges
+
+    With resume the progress of every range is recorded in a sidecar file,
+    the next call only downloads what is missing as long as the remote file
+    did not change. Use _remove_partial to discard it
+
+    Args:
+        url (str): URL of file to download
+        filename (str): output file
+        parts (int): number of concurrent requests
+        resume (bool): continue a previous download of filename
+    """
+    session = session or _get_session()
+    head = session.head(url, allow_redirects=True)
+    size = int(head.headers.get("Content-Length") or 0)
+    if not size or not hasattr(os, "pwrite") or head.status_code != 200 or \
+            head.headers.get("Accept-Ranges") != "bytes":
+        if resume:
+            _remove_partial(filename)
+        download(url, filename, session=session)
+        return
+
+    validator = head.headers.get("ETag") or head.headers.get("Last-Modified")
+    # [offset written so far, end] of every range
+    ranges = _load_progress(filename, size, validator) if resume else None
+    fresh = ranges is None
+    if fresh:
+        if size < parts * _CHUNK_SIZE:
+            parts = 1
+        if parts < 2 and not resume:
+            download(url, filename, session=session)
+            return
+        step = -(-size // parts)
+        ranges = [[start, min(start + step, size)]
+                  for start in range(0, size, step)]
+    pending = [r for r in ranges if r[0] < r[1]]
+    if not pending:
+        return
+
+    # request the final url directly, skipping redirects for every part
+    url = head.url
+    lock = Lock()
+
+    def tracker(r):
+        def update(offset):
+            r[0] = offset
+            with lock:
+                _save_progress(filename, size, validator, ranges)
+        return update if resume else None
+
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if fresh:
+            os.ftruncate(fd, 0)
+            try:
+                # reserve the blocks up front, parts are written out of order
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, size)
+            if resume:
+                # the file is full size already, only the sidecar tells
+                # which parts of it were downloaded
+                _save_progress(filename, size, validator, ranges)
+        with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+            futures = [pool.submit(_download_range, url, fd, r[0], r[1] - 1,
+                                   session, tracker(r))
+                       for r in pending]
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+
+
+def _download_archive(url, folder, filename, suffix, session=None,
+                      parts=_DOWNLOAD_PARTS, resume=False):
+    """ ensure folder exists and download url to filename, a temp file by default """
+    makedirs(folder, exist_ok=True)
+    if not filename:
+        fd, filename = mkstemp(suffix)
+        os.close(fd)
+    parallel_download(url, filename, session=session, parts=parts,
+                      resume=resume)
+    return filename
+
+
+def _sha256_file(filename):
+    """ sha256 hex digest of a downloaded file, read back from the page cache """
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class _HashingReader:
+    """ file like wrapper hashing the bytes read from a stream """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+
+class _StreamPump:
+    """ file like reader fed by a thread downloading the response
+
+    the network transfer keeps going while the consumer decompresses and
+    writes to disk, up to maxsize chunks are buffered in between
+    """
+
+    def __init__(self, response, maxsize=16):
+        self._response = response
+        self._queue = Queue(maxsize)
+        self._chunk = b""
+        self._offset = 0
+        self._error = None
+        self._eof = False
+        self._closed = False
+        self._thread = Thread(target=self._pump, daemon=True)
+        self._thread.start()
+
+    def _pump(self):
+        try:
+            for chunk in self._response.iter_content(chunk_size=_CHUNK_SIZE):
+                if self._closed:
+                    break
+                self._queue.put(chunk)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._queue.put(None)
+
+    def read(self, size=-1):
+        """ read size bytes, less only at the end of the stream """
+        parts = []
+        while size and not self._eof:
+            if self._offset >= len(self._chunk):
+                chunk = self._queue.get()
+                if chunk is None:
+                    self._eof = True
+                    if self._error:
+                        raise self._error
+                    break
+                self._chunk, self._offset = chunk, 0
+            end = len(self._chunk) if size < 0 else self._offset + size
+            data = self._chunk[self._offset:end]
+            self._offset += len(data)
+            if size > 0:
+                size -= len(data)
+            parts.append(data)
+        return b"".join(parts)
+
+    def close(self):
+        """ stop the download thread, unblocking it if the queue is full """
+        self._closed = True
+        while not self._eof:
+            self._eof = self._queue.get() is None
+        self._thread.join()
+
+
+def _rename_extracted(folder, original_folder, final_name):
+    """ rename the top level folder extracted from an archive """
+    src, dst = join(folder, original_folder), join(folder, final_name)
+    try:
+        # same filesystem, a single rename
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def _tar_compression(url):
+    """ tarfile compression name for the archive extension, None if unknown """
+    for ext, compression in ((".tar.gz", "gz"), (".tgz", "gz"),
+                             (".tar.xz", "xz"), (".txz", "xz"),
+                             (".tar.bz2", "bz2"), (".tar", "")):
+        if url.endswith(ext):
+            return compression
+    return None
+
+
+def _write_file(target, data, mode):
+    with open(target, "wb") as f:
+        f.write(data)
+    os.chmod(target, mode & 0o777)
+
+
+def _extract_tar(tar, folder):
+    """ extract every member in a single pass, returns the top level folder
+
+    the archive is read sequentially on this thread, small files are handed
+    to a pool of threads to be written while the next members are read
+    """
+    original_folder = None
+    tar.copybufsize = _COPY_BUFSIZE
+    created = set()
+    slots = Semaphore(_TAR_WORKERS * 8)
+    pending = []
+
+    def wait_pending():
+        for future in pending:
+            future.result()
+        pending.clear()
+
+    with ThreadPoolExecutor(max_workers=_TAR_WORKERS) as pool:
+        for member in tar:
+            if original_folder is None:
+                original_folder = member.name.split("/")[0]
+            parts = [p for p in member.name.split("/")
+                     if p not in ("", ".", "..")]
+            if parts and member.isreg() and \
+                    member.size <= _TAR_WORKER_MAX_SIZE:
+                target = join(folder, *parts)
+                parent = dirname(target)
+                if parent not in created:
+                    makedirs(parent, exist_ok=True)
+                    created.add(parent)
+                data = tar.extractfile(member).read()
+                # bound the file contents waiting in memory
+                slots.acquire()
+                future = pool.submit(_write_file, target, data, member.mode)
+                future.add_done_callback(lambda _: slots.release())
+                pending.append(future)
+                continue
+            if not member.isdir():
+                # links may point to files still being written
+                wait_pending()
+            tar.extract(member, folder)
+        wait_pending()
+    return original_folder
+
+
 def download_extract_tar(tar_url, folder, tar_filename='',
-                         skill_folder_name=None, session=None):
+                         skill_folder_name=None, session=None,
+                         parts=_DOWNLOAD_PARTS):
     """
     Download and extract the tar at the url to the given folder
 
     Args:
         tar_url (str): URL of tar file to download
         folder (str): Location of parent directory to extract to. Doesn't have to exist
-        tar_filename (str): Location to download tar. Default is to a temp file
+        tar_filename (str): Location to download tar. Default is to extract
+            while downloading, without a temp file
         skill_folder_name (str): rename extracted skill folder to this
+        parts (int): concurrent range requests used to download to tar_filename
+
+    Returns:
+        str: sha256 hex digest of the downloaded archive
     """
-    try:
-        makedirs(folder)
-    except OSError:
-        if not isdir(folder):
-            raise
-    if not tar_filename:
-        fd, tar_filename = mkstemp('.tar.gz')
-        download(tar_url, os.fdopen(fd, 'wb'), session=session)
+    # an explicit mode skips probing the archive for its compression
+    compression = _tar_compression(tar_url)
+    if compression is None:
+        compression = "*"
+    isal_gzip = _igzip is not None and compression == "gz"
+    if tar_filename:
+        suffix = ".tar." + compression if compression not in ("", "*") else ".tar"
+        tar_filename = _download_archive(tar_url, folder, tar_filename,
+                                         suffix, session, parts)
+        sha256 = _sha256_file(tar_filename)
+        if isal_gzip:
+            with _igzip.open(tar_filename) as gz, \
+                    tarfile.open(fileobj=gz, mode="r|",
+                                 bufsize=_COPY_BUFSIZE) as tar:
+                original_folder = _extract_tar(tar, folder)
+        else:
+            with tarfile.open(tar_filename, "r:" + compression) as tar:
+                original_folder = _extract_tar(tar, folder)
     else:
-        download(tar_url, tar_filename, session=session)
-
-    with tarfile.open(tar_filename) as tar:
-        tar.extractall(path=folder)
+        makedirs(folder, exist_ok=True)
+        with _request(tar_url, session) as r:
+            # stream mode, members are extracted while a thread keeps
+            # downloading and the archive is hashed on the same read pass
+            pump = _StreamPump(r)
+            try:
+                reader = _HashingReader(pump)
+                if isal_gzip:
+                    fileobj, mode = _igzip.IGzipFile(fileobj=reader), "r|"
+                else:
+                    fileobj, mode = reader, "r|" + compression
+                with tarfile.open(fileobj=fileobj, mode=mode,
+                                  bufsize=_COPY_BUFSIZE) as tar:
+                    original_folder = _extract_tar(tar, folder)
+                # drain trailing padding so the digest covers the whole archive
+                while reader.read(_CHUNK_SIZE):
+                    pass
+                sha256 = reader.hasher.hexdigest()
+            finally:
+                pump.close()
 
     if skill_folder_name:
-        with tarfile.open(tar_filename) as tar:
-            for p in tar.getnames():
-                original_folder = p.split("/")[0]
-                break
-        original_folder = join(folder, original_folder)
-        final_folder = join(folder, skill_folder_name)
-        shutil.move(original_folder, final_folder)
+        _rename_extracted(folder, original_folder, skill_folder_name)
+    return sha256
+
+
+def _extract_zip_member(zip_ref, info, folder):
+    """ ZipFile.extract equivalent, copying with a bigger buffer """
+    parts = [p for p in info.filename.split("/") if p not in ("", ".", "..")]
+    if not parts:
+        return
+    target = join(folder, *parts)
+    if info.is_dir():
+        makedirs(target, exist_ok=True)
+        return
+    makedirs(dirname(target), exist_ok=True)
+    with zip_ref.open(info) as src, open(target, "wb") as dst:
+        shutil.copyfileobj(src, dst, _COPY_BUFSIZE)
+
+
+def _open_zip(source):
+    """ open a zip from a filename or from the archive bytes """
+    if isinstance(source, bytes):
+        # BytesIO shares the bytes buffer, no copy is made
+        return zipfile.ZipFile(io.BytesIO(source), 'r')
+    return zipfile.ZipFile(source, 'r')
+
+
+def _extract_zip(source, folder):
+    """ extract every member of a zip file using a pool of threads
+
+    returns the top level folder of the archive
+    """
+    # ZipFile handles can not be shared between threads, open one per worker
+    worker = local()
+    handles = []
+
+    def extract(info):
+        zip_ref = getattr(worker, "zip_ref", None)
+        if zip_ref is None:
+            zip_ref = worker.zip_ref = _open_zip(source)
+            handles.append(zip_ref)
+        _extract_zip_member(zip_ref, info, folder)
+
+    with _open_zip(source) as zip_ref:
+        infos = zip_ref.infolist()
+    try:
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            # consume the results so worker exceptions are raised
+            for _ in pool.map(extract, infos):
+                pass
+    finally:
+        for zip_ref in handles:
+            zip_ref.close()
+    return infos[0].filename.split("/")[0] if infos else None
 
 
 def download_extract_zip(zip_url, folder, zip_filename="",
-                         skill_folder_name=None, session=None):
+                         skill_folder_name=None, session=None,
+                         parts=_DOWNLOAD_PARTS, cache_folder=None):
     """
    Download and extract the zip at the url to the given folder
 
    Args:
        zip_url (str): URL of zip file to download
        folder (str): Location of parent directory to extract to. Doesn't have to exist
-       zip_filename (str): Location to download zip. Default is to a temp file
+       zip_filename (str): Location to download zip. Default is to keep small
+           archives in memory and download big ones to a temp file
        skill_folder_name (str): rename extracted skill folder to this
+       parts (int): concurrent range requests used to download big archives
+       cache_folder (str): download big archives to a .part file in this
+           folder instead of a temp file, an interrupted download is resumed
+           by the next call and the file is removed once extracted
+
+   Returns:
+       str: sha256 hex digest of the downloaded archive
    """
-    try:
-        makedirs(folder)
-    except OSError:
-        if not isdir(folder):
-            raise
-    if not zip_filename:
-        fd, zip_filename = mkstemp('.tar.gz')
-        download(zip_url, os.fdopen(fd, 'wb'), session=session)
+    temp_file = partial_file = None
+    if zip_filename:
+        source = _download_archive(zip_url, folder, zip_filename, '.zip',
+                                   session, parts)
     else:
-        download(zip_url, zip_filename, session=session)
-
-    with zipfile.ZipFile(zip_filename, 'r') as zip_ref:
-        zip_ref.extractall(folder)
-
-    if skill_folder_name:
-        with zipfile.ZipFile(zip_filename, 'r') as zip_ref:
-            for p in zip_ref.namelist():
-                original_folder = p.split("/")[0]
-                break
-
-        original_folder = join(folder, original_folder)
-        final_folder = join(folder, skill_folder_name)
-        shutil.move(original_folder, final_folder)
+        makedirs(folder, exist_ok=True)
+        size = _content_length(zip_url, session)
+        if size and size < _IN_MEMORY_ZIP_SIZE:
+            source = download(zip_url, session=session)
+        elif cache_folder:
+            partial_file = join(cache_folder, zip_url.split("/")[-1] + ".part")
+            source = _download_archive(zip_url, cache_folder, partial_file,
+                                       '.zip', session, parts, resume=True)
+        else:
+            source = temp_file = _download_archive(zip_url, folder, "", '.zip',
+                                                   session, parts)
+    try:
+        if isinstance(source, bytes):
+            sha256 = hashlib.sha256(source).hexdigest()
+        else:
+            sha256 = _sha256_file(source)
+        original_folder = _extract_zip(source, folder)
+        if skill_folder_name:
+            _rename_extracted(folder, original_folder, skill_folder_name)
+        if partial_file:
+            _remove_partial(partial_file)
+        return sha256
+    except (zipfile.BadZipFile, zlib.error):
+        # a corrupt archive would fail again on every retry
+        if partial_file:
+            _remove_partial(partial_file)
+        raise
+    finally:
+        if temp_file:
+            os.remove(temp_file)
@@ -0,0 +1,376 @@
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from os.path import join, isfile
+from unittest.mock import MagicMock, patch
+
+import ovos_stt_plugin_vosk
+from ovos_stt_plugin_vosk import ModelContainer, download_extract_tar, \
+    download_extract_zip
+
+MODEL_FILES = {"model-1.0/conf/model.conf": b"--sample-frequency=16000",
+               "model-1.0/am/final.mdl": os.urandom(4096)}
+
+
+def make_zip():
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, content in MODEL_FILES.items():
+            z.writestr(name, content)
+    return data.getvalue()
+
+
+def make_tar(mode="w:gz"):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode=mode) as tar:
+        for name, content in MODEL_FILES.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+class FakeResponse:
+    def __init__(self, content, url="", status_code=200, headers=None):
+        self.content = content
+        self.raw = io.BytesIO(content)
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        return iter(lambda: self.raw.read(chunk_size), b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeSession:
+    def __init__(self, content, ranges=True, etag=None):
+        self.content = content
+        self.ranges = ranges
+        self.etag = etag
+        self.requests = []
+
+    def head(self, url, allow_redirects=False):
+        headers = {"Content-Length": str(len(self.content))}
+        if self.ranges:
+            headers["Accept-Ranges"] = "bytes"
+        if self.etag:
+            headers["ETag"] = self.etag
+        return FakeResponse(b"", url, headers=headers)
+
+    def get(self, url, headers=None, stream=False):
+        self.requests.append(headers)
+        if headers and "Range" in headers:
+            start, end = headers["Range"].split("=")[1].split("-")
+            return FakeResponse(self.content[int(start):int(end) + 1], url, 206)
+        return FakeResponse(self.content, url)
+
+
+def fake_session(content, ranges=True):
+    session = FakeSession(content, ranges)
+    return patch.object(ovos_stt_plugin_vosk, "_get_session", lambda: session)
+
+
+class TestDownloadExtract(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, ignore_errors=True)
+
+    def assert_extracted(self, name):
+        for path, content in MODEL_FILES.items():
+            path = join(self.folder, name, path.split("/", 1)[1])
+            self.assertTrue(isfile(path))
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), content)
+
+    def test_zip(self):
+        with fake_session(make_zip()):
+            download_extract_zip("http://fake/model-1.0.zip", self.folder,
+                                 skill_folder_name="model")
+        self.assert_extracted("model")
+
+    def test_zip_temp_file(self):
+        with fake_session(make_zip()), \
+                patch.object(ovos_stt_plugin_vosk, "_IN_MEMORY_ZIP_SIZE", 1), \
+                patch.object(ovos_stt_plugin_vosk, "os", wraps=os) as mock_os:
+            download_extract_zip("http://fake/model-1.0.zip", self.folder,
+                                 skill_folder_name="model")
+        self.assert_extracted("model")
+        # the temp file is cleaned up
+        removed = mock_os.remove.call_args[0][0]
+        self.assertTrue(removed.endswith(".zip"))
+        self.assertFalse(os.path.exists(removed))
+
+    def test_tar(self):
+        with fake_session(make_tar()):
+            download_extract_tar("http://fake/model-1.0.tar.gz", self.folder,
+                                 skill_folder_name="model")
+        self.assert_extracted("model")
+
+    def test_tar_isal(self):
+        # isal.igzip mirrors the stdlib gzip api
+        igzip = MagicMock(open=gzip.open, IGzipFile=MagicMock(wraps=gzip.GzipFile))
+        with fake_session(make_tar()), \
+                patch.object(ovos_stt_plugin_vosk, "_igzip", igzip):
+            download_extract_tar("http://fake/model-1.0.tar.gz", self.folder,
+                                 skill_folder_name="model")
+        self.assert_extracted("model")
+        igzip.IGzipFile.assert_called_once()
+
+    def test_tar_big_members(self):
+        # members over the threshold are extracted on the reading thread
+        with fake_session(make_tar()), \
+                patch.object(ovos_stt_plugin_vosk, "_TAR_WORKER_MAX_SIZE", 100):
+            download_extract_tar("http://fake/model-1.0.tar.gz", self.folder,
+                                 skill_folder_name="model")
+        self.assert_extracted("model")
+
+    def test_tar_file(self):
+        with fake_session(make_tar("w:xz")):
+            download_extract_tar("http://fake/model-1.0.tar.xz", self.folder,
+                                 join(self.folder, "model.tar.xz"),
+                                 skill_folder_name="model")
+        self.assert_extracted("model")
+
+    def test_sha256(self):
+        content = make_tar()
+        with fake_session(content):
+            sha256 = download_extract_tar("http://fake/model-1.0.tar.gz",
+                                          self.folder, skill_folder_name="model")
+        self.assertEqual(sha256, hashlib.sha256(content).hexdigest())
+
+    def test_tar_xz_stream(self):
+        with fake_session(make_tar("w:xz")):
+            download_extract_tar("http://fake/model-1.0.tar.xz", self.folder,
+                                 skill_folder_name="model")
+        self.assert_extracted("model")
+
+
+class TestSession(unittest.TestCase):
+    def test_shared_session(self):
+        with patch.object(ovos_stt_plugin_vosk, "_SESSION", None):
+            session = ovos_stt_plugin_vosk._get_session()
+            self.assertIs(ovos_stt_plugin_vosk._get_session(), session)
+            adapter = session.get_adapter("https://alphacephei.com")
+            self.assertEqual(adapter.max_retries.total, 3)
+
+
+class TestStreamPump(unittest.TestCase):
+    def test_read(self):
+        content = os.urandom(3 * 1024 * 1024 + 7)
+        pump = ovos_stt_plugin_vosk._StreamPump(FakeResponse(content))
+        data = pump.read(10240) + pump.read(2 * 1024 * 1024) + pump.read()
+        self.assertEqual(data, content)
+        self.assertEqual(pump.read(10), b"")
+        pump.close()
+
+    def test_error(self):
+        def iter_content(chunk_size):
+            yield b"abc"
+            raise IOError("connection reset")
+
+        response = FakeResponse(b"")
+        response.iter_content = iter_content
+        pump = ovos_stt_plugin_vosk._StreamPump(response)
+        with self.assertRaises(IOError):
+            pump.read()
+        pump.close()
+
+    def test_close_unblocks(self):
+        pump = ovos_stt_plugin_vosk._StreamPump(
+            FakeResponse(os.urandom(4 * 1024 * 1024)), maxsize=1)
+        pump.read(10)
+        pump.close()
+        self.assertFalse(pump._thread.is_alive())
+
+
+class TestTarCompression(unittest.TestCase):
+    def test_tar_compression(self):
+        tar_compression = ovos_stt_plugin_vosk._tar_compression
+        self.assertEqual(tar_compression("http://fake/model.tar.gz"), "gz")
+        self.assertEqual(tar_compression("http://fake/model.tgz"), "gz")
+        self.assertEqual(tar_compression("http://fake/model-fr.tar.xz"), "xz")
+        self.assertEqual(tar_compression("http://fake/model.tar"), "")
+        self.assertIsNone(tar_compression("http://fake/model"))
+
+
+class TestDownloadModel(unittest.TestCase):
+    def setUp(self):
+        self.data_home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_home, ignore_errors=True)
+        ModelContainer._manifest = None
+        patches = [patch.object(ovos_stt_plugin_vosk, "xdg_data_home",
+                                lambda: self.data_home),
+                   patch.object(ovos_stt_plugin_vosk, "is_connected",
+                                lambda: True)]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        ModelContainer._manifest = None
+
+    def test_download_model(self):
+        url = "http://fake/model-1.0.zip"
+        session = FakeSession(make_zip())
+        with patch.object(ovos_stt_plugin_vosk, "_get_session", lambda: session):
+            path = ModelContainer.download_model(url)
+            self.assertEqual(path, join(self.data_home, "vosk", "model-1.0"))
+            self.assertTrue(isfile(join(path, "conf", "model.conf")))
+            self.assertEqual(len(session.requests), 1)
+
+            # the manifest is persisted and reused, no second download
+            ModelContainer._manifest = None
+            self.assertEqual(ModelContainer.download_model(url), path)
+            self.assertEqual(len(session.requests), 1)
+            self.assertIn(url, ModelContainer.load_manifest())
+            self.assertEqual(ModelContainer.load_manifest()[url]["sha256"],
+                             hashlib.sha256(session.content).hexdigest())
+
+    def test_partial_archive_removed(self):
+        url = "http://fake/model-1.0.zip"
+        with fake_session(make_zip()), \
+                patch.object(ovos_stt_plugin_vosk, "_IN_MEMORY_ZIP_SIZE", 1):
+            path = ModelContainer.download_model(url)
+        self.assertTrue(isfile(join(path, "conf", "model.conf")))
+        # the resumable archive is removed once extracted
+        self.assertEqual(sorted(os.listdir(join(self.data_home, "vosk"))),
+                         ["manifest.json", "model-1.0"])
+
+    def test_corrupt_archive_discarded(self):
+        url = "http://fake/model-1.0.zip"
+        content = bytearray(make_zip())
+        content[len(content) // 2] ^= 0xFF
+        with patch.object(ovos_stt_plugin_vosk, "_IN_MEMORY_ZIP_SIZE", 1):
+            with fake_session(bytes(content)):
+                with self.assertRaises(Exception):
+                    ModelContainer.download_model(url)
+            # the corrupt archive is not resumed, the next call downloads it again
+            self.assertEqual(os.listdir(join(self.data_home, "vosk")), [])
+            with fake_session(make_zip()):
+                path = ModelContainer.download_model(url)
+        self.assertTrue(isfile(join(path, "conf", "model.conf")))
+
+    def test_wait_for_internet(self):
+        connected = iter([False] * 7 + [True])
+        with fake_session(make_zip()), \
+                patch.object(ovos_stt_plugin_vosk, "is_connected",
+                             lambda: next(connected)), \
+                patch.object(ovos_stt_plugin_vosk, "sleep") as sleep:
+            ModelContainer.download_model("http://fake/model-1.0.zip")
+        self.assertEqual([c[0][0] for c in sleep.call_args_list],
+                         [0.5, 1, 2, 4, 8, 10, 10])
+
+    def test_interrupted_download(self):
+        url = "http://fake/model-1.0.zip"
+        with fake_session(make_zip()[:-100]):
+            with self.assertRaises(Exception):
+                ModelContainer.download_model(url)
+        # nothing is left behind that would be mistaken for a model
+        self.assertEqual(os.listdir(join(self.data_home, "vosk")), [])
+        self.assertNotIn(url, ModelContainer.load_manifest())
+
+
+class TestParallelDownload(unittest.TestCase):
+    def setUp(self):
+        self.content = os.urandom(5 * 1024 * 1024 + 123)
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(ovos_stt_plugin_vosk._remove_partial, self.filename)
+
+    def test_parallel_download(self):
+        session = FakeSession(self.content)
+        ovos_stt_plugin_vosk.parallel_download("http://fake/model.zip",
+                                               self.filename, session, parts=4)
+        self.assertEqual(len(session.requests), 4)
+        with open(self.filename, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_single_part(self):
+        session = FakeSession(self.content)
+        ovos_stt_plugin_vosk.parallel_download("http://fake/model.zip",
+                                               self.filename, session, parts=1)
+        self.assertEqual(session.requests, [None])
+        with open(self.filename, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_resume(self):
+        class FailingSession(FakeSession):
+            def get(self, url, headers=None, stream=False):
+                if self.fail and not headers["Range"].startswith("bytes=0-"):
+                    raise IOError("connection reset")
+                return super().get(url, headers, stream)
+
+        session = FailingSession(self.content)
+        session.fail = True
+        with self.assertRaises(IOError):
+            ovos_stt_plugin_vosk.parallel_download(
+                "http://fake/model.zip", self.filename, session, parts=4,
+                resume=True)
+
+        # only the parts that failed are downloaded again
+        session.fail = False
+        session.requests.clear()
+        ovos_stt_plugin_vosk.parallel_download(
+            "http://fake/model.zip", self.filename, session, parts=4,
+            resume=True)
+        self.assertEqual(len(session.requests), 3)
+        self.assertNotIn("bytes=0-", [r["Range"][:8] for r in session.requests])
+        with open(self.filename, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+        # already complete, nothing is downloaded
+        session.requests.clear()
+        ovos_stt_plugin_vosk.parallel_download("http://fake/model.zip",
+                                               self.filename, session,
+                                               resume=True)
+        self.assertEqual(session.requests, [])
+
+    def test_resume_without_progress(self):
+        # a full size file left by a killed download, without its sidecar
+        with open(self.filename, "wb") as f:
+            f.write(bytes(len(self.content)))
+        session = FakeSession(self.content)
+        ovos_stt_plugin_vosk.parallel_download("http://fake/model.zip",
+                                               self.filename, session, parts=4,
+                                               resume=True)
+        self.assertEqual(len(session.requests), 4)
+        with open(self.filename, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_resume_remote_changed(self):
+        session = FakeSession(self.content, etag='"v1"')
+        ovos_stt_plugin_vosk.parallel_download("http://fake/model.zip",
+                                               self.filename, session, parts=4,
+                                               resume=True)
+        # a new version of the file is downloaded from scratch
+        content = os.urandom(len(self.content))
+        session = FakeSession(content, etag='"v2"')
+        ovos_stt_plugin_vosk.parallel_download("http://fake/model.zip",
+                                               self.filename, session, parts=4,
+                                               resume=True)
+        self.assertEqual(len(session.requests), 4)
+        with open(self.filename, "rb") as f:
+            self.assertEqual(f.read(), content)
+
+    def test_no_range_support(self):
+        session = FakeSession(self.content, ranges=False)
+        ovos_stt_plugin_vosk.parallel_download("http://fake/model.zip",
+                                               self.filename, session, parts=4)
+        self.assertEqual(session.requests, [None])
+        with open(self.filename, "rb") as f:
+            self.assertEqual(f.read(), self.content)
@@ -0,0 +1,399 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import ovos_stt_plugin_vosk
+from ovos_stt_plugin_vosk import ModelContainer, VoskKaldiStreamThread, _AudioQueue
+
+
+@patch.object(ovos_stt_plugin_vosk, "KaldiRecognizer")
+@patch.object(ovos_stt_plugin_vosk, "KaldiModel")
+class TestModelContainer(unittest.TestCase):
+    def setUp(self):
+        ModelContainer._MODEL_REGISTRY.clear()
+        ModelContainer._MODEL_USERS.clear()
+
+    def test_model_loaded_once(self, model, recognizer):
+        m1 = ModelContainer.get_kaldi_model("/fake/model")
+        m2 = ModelContainer.get_kaldi_model("/fake/model")
+        self.assertIs(m1, m2)
+        model.assert_called_once_with("/fake/model")
+
+        ModelContainer.get_kaldi_model("/fake/other")
+        self.assertEqual(model.call_count, 2)
+
+    def test_vocabulary_switch_reuses_model(self, model, recognizer):
+        container = ModelContainer()
+        container.load_model("/fake/model", "en-US")
+        container.enable_limited_vocabulary(["yes", "no"], "en-US")
+        container.enable_full_vocabulary("en-US")
+        model.assert_called_once_with("/fake/model")
+        self.assertEqual(recognizer.call_count, 2)
+
+        # recognizers are cached per grammar and reset before reuse
+        container.enable_limited_vocabulary(["yes", "no"], "en-US")
+        self.assertEqual(recognizer.call_count, 2)
+        container.engines["en"].Reset.assert_called()
+
+    def test_partial_layout(self, model, recognizer):
+        engine = recognizer.return_value
+        engine.PartialResult.return_value = '{\n  "partial" : ""\n}'
+        container = ModelContainer()
+        container.load_model("/fake/model", "en")
+        self.assertEqual(container._partial_affixes,
+                         ('{\n  "partial" : "', '"\n}'))
+
+        engine.PartialResult.return_value = '{\n  "partial" : "hello world"\n}'
+        self.assertEqual(container.get_partial_transcription("en"), "hello world")
+        engine.PartialResult.return_value = '{"partial" : "say \\"hi\\""}'
+        self.assertEqual(container.get_partial_transcription("en"), 'say "hi"')
+
+    def test_process_audio_data(self, model, recognizer):
+        from speech_recognition import AudioData
+        container = ModelContainer()
+        container.load_model("/fake/model", "en")
+        engine = container.engines["en"]
+        pcm = b"\x01\x02" * 800
+        container.process_audio(AudioData(pcm, 16000, 2), "en")
+        engine.AcceptWaveform.assert_called_with(pcm)
+        container.process_audio(pcm, "en")
+        engine.AcceptWaveform.assert_called_with(pcm)
+
+    def test_long_audio_in_blocks(self, model, recognizer):
+        container = ModelContainer()
+        container.load_model("/fake/model", "en")
+        engine = container.engines["en"]
+        engine.AcceptWaveform.reset_mock()
+        # 2.5s of audio, fed in 1s blocks
+        container.process_audio(bytes(80000), "en")
+        self.assertEqual([len(c[0][0]) for c in engine.AcceptWaveform.call_args_list],
+                         [32000, 32000, 16000])
+
+
+class TestResultParsing(unittest.TestCase):
+    def test_extract_result(self):
+        from ovos_stt_plugin_vosk import _extract_result, _PARTIAL_RE, _TEXT_RE
+        self.assertEqual(_extract_result('{\n  "partial" : "hello world"\n}',
+                                         _PARTIAL_RE, "partial"), "hello world")
+        self.assertEqual(_extract_result('{\n  "partial" : ""\n}',
+                                         _PARTIAL_RE, "partial"), "")
+        self.assertEqual(_extract_result('{\n  "text" : "olá mundo"\n}',
+                                         _TEXT_RE, "text"), "olá mundo")
+        # escape sequences fall back to a json parse
+        self.assertEqual(_extract_result('{"text" : "say \\"hi\\""}',
+                                         _TEXT_RE, "text"), 'say "hi"')
+
+
+class TestStreamThread(unittest.TestCase):
+    def test_audio_is_batched(self):
+        model = MagicMock()
+        model.get_partial_transcription.return_value = "hello"
+        model.get_final_transcription.return_value = "hello world"
+        # 20ms chunks, 100ms batches
+        chunk = b"\x00" * 640
+        thread = VoskKaldiStreamThread(None, "en-US", model, verbose=False)
+        thread.handle_audio_stream([chunk] * 12, "en-US")
+        self.assertEqual(model.process_audio.call_count, 2)
+        self.assertEqual(len(model.process_audio.call_args[0][0]), 3200)
+
+        # the remaining 40ms are flushed on finalize
+        self.assertEqual(thread.finalize(), "hello world")
+        self.assertEqual(model.process_audio.call_count, 3)
+        self.assertEqual(len(model.process_audio.call_args[0][0]), 1280)
+
+    def test_queue_drained_in_bulk(self):
+        queue = _AudioQueue(100)
+        for i in range(5):
+            queue.put(bytes([i]) * 640)
+        queue.put(None)
+        thread = VoskKaldiStreamThread(queue, "en-US", MagicMock(),
+                                       verbose=False)
+        chunks = list(thread._get_data())
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0], b"".join(bytes([i]) * 640 for i in range(5)))
+        self.assertEqual(queue.unfinished_tasks, 0)
+
+    def test_stream_language(self):
+        model = MagicMock()
+        model.get_partial_transcription.return_value = "olá"
+        thread = VoskKaldiStreamThread(None, "en-US", model, verbose=False)
+        # the stream language is only set after the thread is created
+        thread.language = "pt-PT"
+        thread.handle_audio_stream([b"\x00" * 3200], "pt-PT")
+        model.checkout_engine.assert_called_once_with("pt-PT")
+        engine = model.checkout_engine.return_value
+        self.assertIs(model.process_audio.call_args[0][2], engine)
+        thread.finalize()
+        model.checkin_engine.assert_called_once_with(engine)
+
+    def test_queue_drops_oldest(self):
+        queue = _AudioQueue(2)
+        with patch.object(ovos_stt_plugin_vosk.LOG, "warning") as warning:
+            for i in range(5):
+                queue.put(bytes([i]))
+        self.assertEqual(list(queue.queue), [b"\x03", b"\x04"])
+        # dropped chunks do not count as pending, join does not block
+        self.assertEqual(queue.unfinished_tasks, 2)
+        # rate limited
+        warning.assert_called_once()
+        queue.get(), queue.get()
+        queue.task_done(), queue.task_done()
+        queue.join()
+
+    def test_stops_when_finalized(self):
+        model = MagicMock()
+        model.get_partial_transcription.return_value = ""
+        thread = VoskKaldiStreamThread(None, "en-US", model, verbose=False,
+                                       batch_ms=0)
+
+        def audio():
+            yield b"\x00" * 640
+            thread.finalize()
+            while True:
+                yield b"\x00" * 640
+
+        thread.handle_audio_stream(audio(), "en-US")
+        self.assertEqual(model.process_audio.call_count, 1)
+
+    def test_partial_interval(self):
+        model = MagicMock()
+        model.process_audio.return_value = False
+        model.get_partial_transcription.return_value = "hello"
+        thread = VoskKaldiStreamThread(None, "en-US", model, verbose=False,
+                                       batch_ms=0, partial_interval=4)
+        thread.handle_audio_stream([b"\x00" * 640] * 8, "en-US")
+        self.assertEqual(model.get_partial_transcription.call_count, 2)
+
+        # endpoints always read the partial
+        model.process_audio.return_value = True
+        thread.handle_audio_stream([b"\x00" * 640] * 3, "en-US")
+        self.assertEqual(model.get_partial_transcription.call_count, 5)
+
+    def test_bulk_audio(self):
+        model = MagicMock()
+        model.get_partial_transcription.return_value = "hello"
+        thread = VoskKaldiStreamThread(None, "en-US", model, verbose=False)
+        self.assertEqual(thread.handle_bulk_audio(bytes(8000)), "hello")
+        self.assertEqual([len(c[0][0]) for c in model.process_audio.call_args_list],
+                         [3200, 3200, 1600])
+
+    def test_bulk_audio_after_stream(self):
+        model = MagicMock()
+        model.get_partial_transcription.return_value = "hello"
+        thread = VoskKaldiStreamThread(None, "en-US", model, verbose=True)
+        # 40ms buffered by the stream, not yet a full batch
+        thread.handle_audio_stream([b"\x01" * 1280], "en-US")
+        with patch.object(ovos_stt_plugin_vosk._PartialLogger, "log") as log:
+            thread.handle_bulk_audio(bytes(3200))
+        # decoded in the order it was received
+        self.assertEqual([c[0][0][:1] for c in model.process_audio.call_args_list],
+                         [b"\x01", b"\x00"])
+        log.assert_called_once_with("hello")
+
+    def test_audio_queue_drops_oldest(self):
+        q = _AudioQueue(2)
+        for i in range(4):
+            q.put_nowait(i)
+        q.put(None)
+        self.assertEqual([q.get_nowait(), q.get_nowait()], [3, None])
+        self.assertTrue(q.empty())
+
+
+class TestLang2ModelUrl(unittest.TestCase):
+    def test_lang2modelurl(self):
+        self.assertTrue(ModelContainer.lang2modelurl("en-in").endswith(
+            "vosk-model-small-en-in-0.4.zip"))
+        self.assertTrue(ModelContainer.lang2modelurl("en-US").endswith(
+            "vosk-model-small-en-us-0.15.zip"))
+        self.assertIsNone(ModelContainer.lang2modelurl("xx"))
+
+        self.assertTrue(ModelContainer.lang2modelurl("de", small=False).endswith(
+            "vosk-model-de-0.6.zip"))
+        self.assertTrue(ModelContainer.lang2modelurl("pt", small=False).endswith(
+            "vosk-model-small-pt-0.3.zip"))
+        # requesting a big model does not change the small model table
+        self.assertTrue(ModelContainer.lang2modelurl("de").endswith(
+            "vosk-model-small-de-0.15.zip"))
+
+
+@patch.object(ovos_stt_plugin_vosk, "KaldiRecognizer")
+@patch.object(ovos_stt_plugin_vosk, "KaldiModel")
+class TestUnload(unittest.TestCase):
+    def setUp(self):
+        ModelContainer._MODEL_REGISTRY.clear()
+        ModelContainer._MODEL_USERS.clear()
+
+    def test_unload_language(self, model, recognizer):
+        container = ModelContainer()
+        container.load_model("/fake/model", "en")
+        container.load_model("/fake/model", "pt")
+        container.unload_language("en-US")
+        container.unload_language("en")
+        self.assertEqual(list(container.engines), ["pt"])
+        # still used by pt
+        self.assertIn("/fake/model", ModelContainer._MODEL_REGISTRY)
+        container.unload_language("pt")
+        self.assertNotIn("/fake/model", ModelContainer._MODEL_REGISTRY)
+
+    def test_vocabulary_switch_after_eviction(self, model, recognizer):
+        container = ModelContainer(max_languages=2)
+        container.load_model("/fake/en", "en")
+        container.load_model("/fake/pt", "pt")
+        container.load_model("/fake/es", "es")
+        self.assertNotIn("/fake/en", ModelContainer._MODEL_REGISTRY)
+        container.enable_full_vocabulary("en")
+        container.enable_limited_vocabulary(["yes"], "en")
+        container.unload_language("en")
+        self.assertNotIn("/fake/en", ModelContainer._MODEL_REGISTRY)
+
+    def test_model_shared_between_containers(self, model, recognizer):
+        first, second = ModelContainer(), ModelContainer()
+        first.load_model("/fake/model", "en")
+        second.load_model("/fake/model", "en")
+        first.unload_language("en")
+        # still used by the other container, not loaded a second time
+        self.assertIn("/fake/model", ModelContainer._MODEL_REGISTRY)
+        second.get_recognizer("en", '["yes"]')
+        model.assert_called_once_with("/fake/model")
+        second.unload_language("en")
+        self.assertNotIn("/fake/model", ModelContainer._MODEL_REGISTRY)
+        self.assertEqual(ModelContainer._MODEL_USERS, {})
+
+    def test_least_recently_used_evicted(self, model, recognizer):
+        container = ModelContainer(max_languages=2)
+        container.load_model("/fake/en", "en")
+        container.load_model("/fake/pt", "pt")
+        container.get_engine("en")
+        container.load_model("/fake/es", "es")
+        self.assertEqual(list(container.engines), ["en", "es"])
+
+        # reloaded from the same model, without downloading
+        with patch.object(ModelContainer, "download_language") as download:
+            container.get_engine("pt")
+            download.assert_not_called()
+        self.assertEqual(list(container.engines), ["es", "pt"])
+
+    def test_recognizer_pool(self, model, recognizer):
+        recognizer.side_effect = lambda *args: MagicMock()
+        container = ModelContainer()
+        container.load_model("/fake/model", "en")
+        self.assertEqual(recognizer.call_count, 1)
+        # the cached recognizer is handed out first, no extra one is built
+        first = container.checkout_engine("en-US")
+        self.assertIs(first, container.get_engine("en"))
+        container.checkin_engine(first)
+        self.assertIs(container.checkout_engine("en"), first)
+        self.assertEqual(recognizer.call_count, 1)
+
+        # concurrent streams never share a recognizer
+        second = container.checkout_engine("en")
+        self.assertIsNot(first, second)
+        self.assertEqual(recognizer.call_count, 2)
+        container.checkin_engine(second)
+        self.assertIs(container.checkout_engine("en"), second)
+
+        # recognizers go back to the vocabulary they were created for
+        container.enable_limited_vocabulary(["yes", "no"], "en")
+        container.checkin_engine(first)
+        container.checkin_engine(second)
+        self.assertEqual(container.pools, {("en", None): [second]})
+        limited = container.checkout_engine("en")
+        self.assertIs(limited, container.get_engine("en"))
+        self.assertEqual(recognizer.call_args[0][2], '["yes", "no"]')
+        container.checkin_engine(limited)
+
+        container.unload_language("en")
+        self.assertEqual(container.pools, {})
+
+    def test_concurrent_checkout(self, model, recognizer):
+        from concurrent.futures import ThreadPoolExecutor
+        from time import sleep
+
+        def make_recognizer(*args):
+            engine = MagicMock()
+            # vosk releases the GIL in Reset, let other threads run
+            engine.Reset.side_effect = lambda: sleep(0.01)
+            return engine
+
+        recognizer.side_effect = make_recognizer
+        container = ModelContainer()
+        container.load_model("/fake/model", "en")
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            engines = list(pool.map(container.checkout_engine, ["en"] * 4))
+        # never the same recognizer twice
+        self.assertEqual(len(set(map(id, engines))), 4)
+
+        # concurrent first calls load the language once
+        container = ModelContainer()
+        with patch.object(ModelContainer, "download_language",
+                          return_value="/fake/model") as download:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                engines = list(pool.map(container.checkout_engine, ["pt"] * 4))
+        download.assert_called_once()
+        self.assertEqual(len(set(map(id, engines))), 4)
+
+    def test_load_languages(self, model, recognizer):
+        container = ModelContainer(max_languages=None)
+        paths = {"en": "/fake/en", "pt": "/fake/pt", "es": "/fake/en"}
+        with patch.object(ModelContainer, "download_language",
+                          side_effect=lambda lang, parallel: paths[lang]):
+            container.load_languages(["en-US", "pt", "es", "en"])
+        self.assertEqual(list(container.engines), ["en", "pt", "es"])
+        # en and es share a model, it is only loaded once
+        self.assertEqual(sorted(c[0][0] for c in model.call_args_list),
+                         ["/fake/en", "/fake/pt"])
+
+    def test_load_languages_limit(self, model, recognizer):
+        container = ModelContainer()
+        container.load_model("/fake/en", "en")
+        paths = {"pt": "/fake/pt", "es": "/fake/es", "de": "/fake/de"}
+        with patch.object(ModelContainer, "download_language",
+                          side_effect=lambda lang, parallel: paths[lang]) as download:
+            container.load_languages(["en", "pt", "es", "de"])
+        # only what fits in max_languages is loaded, en is not evicted
+        self.assertEqual(list(container.engines), ["en", "pt"])
+        download.assert_called_once_with("pt", True)
+        self.assertEqual(sorted(c[0][0] for c in model.call_args_list),
+                         ["/fake/en", "/fake/pt"])
+
+
+class TestPluginConfig(unittest.TestCase):
+    def test_config(self):
+        from ovos_stt_plugin_vosk import VoskSTTConfig
+        self.assertIs(VoskSTTConfig, ovos_stt_plugin_vosk.VoskSTTConfig)
+        self.assertEqual([m["meta"]["display_name"] for m in VoskSTTConfig["de"]],
+                         ["vosk-model-small-de-0.15 (Small)",
+                          "vosk-model-de-0.6 (Large)"])
+        self.assertEqual(len(VoskSTTConfig["pt"]), 1)
+
+
+@patch.object(ovos_stt_plugin_vosk, "KaldiRecognizer")
+@patch.object(ovos_stt_plugin_vosk, "KaldiModel")
+class TestPlugin(unittest.TestCase):
+    def setUp(self):
+        ModelContainer._MODEL_REGISTRY.clear()
+
+    def test_background_load(self, model, recognizer):
+        from threading import Event
+        from ovos_stt_plugin_vosk import VoskKaldiSTT
+        loaded = Event()
+        model.side_effect = lambda path: loaded.wait(5)
+        stt = VoskKaldiSTT(config={"model": "/fake/model", "lang": "en-US",
+                                   "background_load": True})
+        self.assertNotIn("en", stt.model.engines)
+        loaded.set()
+        stt.wait_until_ready()
+        self.assertIn("en", stt.model.engines)
+
+    def test_shutdown_while_loading(self, model, recognizer):
+        from threading import Event, Timer
+        from ovos_stt_plugin_vosk import VoskKaldiSTT
+        ModelContainer._MODEL_USERS.clear()
+        loaded = Event()
+        model.side_effect = lambda path: loaded.wait(5)
+        stt = VoskKaldiSTT(config={"model": "/fake/model", "lang": "en-US",
+                                   "background_load": True})
+        Timer(0.05, loaded.set).start()
+        # waits for the running load instead of racing it
+        stt.shutdown()
+        self.assertEqual(dict(stt.model.engines), {})
+        self.assertNotIn("/fake/model", ModelContainer._MODEL_REGISTRY)